@@ -1,5 +1,13 @@
 import gzip
 import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from collections.abc import Mapping
+import numpy as np
 from Bio.bgzf import BgzfWriter
 from typing import TextIO, Optional
 import subprocess
@@ -28,7 +36,9 @@ def main():
     if os.path.basename(infilepath).endswith(".bam"):
         replace_string_in_bam(infilepath, outfilepath, replacement_dict, num_thread=args.num_thread)
     else:
-        replace_string_in_file(infilepath, outfilepath, replacement_dict)
+        stage_times = replace_string_in_file(infilepath, outfilepath, replacement_dict)
+        for stage, times in stage_times.items():
+            print(f"{stage}: busy {times['busy']:.2f}s, waiting {times['waiting']:.2f}s")
     return
 
 
@@ -58,9 +68,23 @@ def parse_args():
 ########################################################################################################
 
 
-def replace_string_in_file(infilename, outfilename, replacement_dict):
+PIPELINE_BUFFER_SIZE = 4 * 1024 * 1024
+PIPELINE_QUEUE_SIZE = 4
+_END_OF_STREAM = None
+
+
+def replace_string_in_file(infilename, outfilename, replacement_dict,
+                           buffer_size=PIPELINE_BUFFER_SIZE, queue_size=PIPELINE_QUEUE_SIZE):
     """
     Handle's the string replacement over entire file.
+    The work is split into three stages running concurrently in their own threads,
+    connected by queues holding at most `queue_size` buffers each:
+        reader      : read `buffer_size` bytes at a time and decompress them
+        transformer : replace strings in whole lines of the decompressed buffers
+        writer      : compress and write the buffers to `outfilename`
+    zlib and file I/O release the GIL, so a stalled disk does not stall the CPU-bound
+    stages and vice versa, while the bounded queues keep memory use bounded.
+    If any stage fails, the reader and transformer stop at their next buffer.
 
     :param infilename: str
     Path to input file.
@@ -71,13 +95,112 @@ def replace_string_in_file(infilename, outfilename, replacement_dict):
     :param replacement_dict: dict
     String mapping
 
-    :return: None
+    :param buffer_size: int
+    Number of bytes read from `infilename` at a time.
+
+    :param queue_size: int
+    Maximum number of buffers waiting between two stages.
+
+    :return: dict
+    Seconds each stage spent busy and waiting on its neighbours, keyed by stage name.
     """
     compression = "bgzip" if "gz" in outfilename.lower() else None
-    with infile_handler(infilename) as infile, outfile_handler(outfilename, compression=compression) as outfile:
-        for line in infile:
-            outfile.write(replace_string(line, replacement_dict))
-    return
+    decompressed_queue = queue.Queue(maxsize=queue_size)
+    replaced_queue = queue.Queue(maxsize=queue_size)
+    # Set once the consuming stage has read the end-of-stream marker from the queue.
+    decompressed_ended = threading.Event()
+    replaced_ended = threading.Event()
+    # Set by a failing stage so that the others stop instead of processing the rest of the file.
+    cancelled = threading.Event()
+    stage_times = {name: {"busy": 0.0, "waiting": 0.0} for name in ["reader", "transformer", "writer"]}
+    errors = []
+
+    def reader():
+        with open(infilename, 'rb') as infile:
+            for chunk in iter_decompressed_chunks(infile, buffer_size, is_gzip(infilename)):
+                if cancelled.is_set():
+                    return
+                _timed_put(decompressed_queue, chunk, stage_times["reader"])
+
+    def transformer():
+        remainder = b''
+        while True:
+            chunk = _timed_get(decompressed_queue, stage_times["transformer"], decompressed_ended)
+            if chunk is _END_OF_STREAM:
+                break
+            if cancelled.is_set():
+                return
+            # Only replace whole lines so that no key is split across two buffers.
+            chunk = remainder + chunk
+            line_end = chunk.rfind(b'\n') + 1
+            remainder = chunk[line_end:]
+            if line_end:
+                _timed_put(replaced_queue, replace_bytes(chunk[:line_end], replacement_dict),
+                           stage_times["transformer"])
+        if remainder:
+            _timed_put(replaced_queue, replace_bytes(remainder, replacement_dict), stage_times["transformer"])
+
+    def writer():
+        with outfile_handler(outfilename, compression=compression, binary=True) as outfile:
+            while True:
+                chunk = _timed_get(replaced_queue, stage_times["writer"], replaced_ended)
+                if chunk is _END_OF_STREAM:
+                    break
+                outfile.write(chunk)
+
+    threads = [
+        threading.Thread(target=_run_stage, args=(reader, None, None, decompressed_queue,
+                                                  stage_times["reader"], errors, cancelled)),
+        threading.Thread(target=_run_stage, args=(transformer, decompressed_queue, decompressed_ended,
+                                                  replaced_queue, stage_times["transformer"], errors, cancelled)),
+    ]
+    for thread in threads:
+        thread.start()
+    _run_stage(writer, replaced_queue, replaced_ended, None, stage_times["writer"], errors, cancelled)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return stage_times
+
+
+def _run_stage(stage, inqueue, inqueue_ended, outqueue, stage_time, errors, cancelled):
+    """
+    Run a pipeline stage and record its wall time. On failure, the error is recorded and
+    `cancelled` is set so that the other stages stop at their next buffer. Once cancelled,
+    unless the end-of-stream marker has already been read (`inqueue_ended` is set),
+    the input queue is drained so that an upstream stage blocked on a full queue can
+    get to its check of `cancelled`.
+    The downstream stage is always told that the stream has ended.
+    """
+    start = time.perf_counter()
+    try:
+        stage()
+    except Exception as error:
+        errors.append(error)
+        cancelled.set()
+    finally:
+        if cancelled.is_set() and inqueue is not None and not inqueue_ended.is_set():
+            while inqueue.get() is not _END_OF_STREAM:
+                pass
+        if outqueue is not None:
+            outqueue.put(_END_OF_STREAM)
+        stage_time["busy"] = time.perf_counter() - start - stage_time["waiting"]
+
+
+def _timed_get(inqueue, stage_time, ended):
+    start = time.perf_counter()
+    item = inqueue.get()
+    stage_time["waiting"] += time.perf_counter() - start
+    if item is _END_OF_STREAM:
+        ended.set()
+    return item
+
+
+def _timed_put(outqueue, item, stage_time):
+    start = time.perf_counter()
+    outqueue.put(item)
+    stage_time["waiting"] += time.perf_counter() - start
 
 
 def replace_string_in_bam(inbam_name, outbam_name, replacement_dict, num_thread=4):
@@ -121,13 +244,17 @@ def read_string_replacement_file(filepath, sep='\t'):
     """
     Read the `replacement_file` which is a 2-column file with columns
     separated by `sep` recording the string replacement map.
+    If `filepath` is a replacement map compiled by `compile_string_replacement_file`,
+    it is memory-mapped instead of parsed.
 
     :param filepath: str
      Path to `replacement_file`
     :param sep: chr
     Column separating character.
-    :return: dict
+    :return: dict or CompiledReplacementMap
     """
+    if is_compiled_replacement_file(filepath):
+        return CompiledReplacementMap(filepath)
     replacement_dict = {}
     with open(filepath) as infile:
         for line in infile:
@@ -136,6 +263,260 @@ def read_string_replacement_file(filepath, sep='\t'):
     return replacement_dict
 
 
+COMPILED_MAP_MAGIC = b"GFSRMAP2"
+COMPILED_MAP_MAGIC_PREFIX = b"GFSRMAP"
+# magic, number of entries, key width, value width, number of distinct key lengths
+COMPILED_MAP_HEADER = struct.Struct("<8sQQQQ")
+COMPILED_MAP_HEADER_SIZE = 64
+
+
+def compile_string_replacement_file(filepath, outfilepath, sep='\t'):
+    """
+    Compile a `replacement_file` into a read-only binary form that can be memory-mapped
+    by `CompiledReplacementMap`. The file holds a header, the entries as fixed-width
+    UTF-8 (key, value) records sorted by key, the original line order of the entries,
+    the distinct key lengths and bitmaps of the first byte and first byte pair of the keys.
+
+    Maps where a key occurs within another key or within a value are refused, since replacing
+    them one key after another, as done with the TSV-file, depends on the order of the keys.
+
+    :param filepath: str
+    Path to `replacement_file`
+
+    :param outfilepath: str
+    Path to the compiled output file. Existing file will be overwritten.
+
+    :param sep: chr
+    Column separating character.
+
+    :return: None
+    """
+    replacement_dict = read_string_replacement_file(filepath, sep=sep)
+    keys = [key.encode("utf-8") for key in replacement_dict.keys()]
+    vals = [val.encode("utf-8") for val in replacement_dict.values()]
+    if any(b'\x00' in s for s in keys + vals):
+        raise ValueError("Null characters are not supported in a compiled replacement map.")
+    if not all(keys):
+        raise ValueError("Empty keys are not supported in a compiled replacement map.")
+    key_width = max([len(key) for key in keys], default=0) or 1
+    val_width = max([len(val) for val in vals], default=0) or 1
+    records = np.array(list(zip(keys, vals)), dtype=[("key", f"S{key_width}"), ("val", f"S{val_width}")])
+    sorted_index = np.argsort(records["key"], kind="stable")
+    order = np.empty(len(records), dtype="<i8")
+    order[sorted_index] = np.arange(len(records))  # line number -> position in sorted records
+
+    sorted_keys = records["key"][sorted_index]
+    key_lengths = np.char.str_len(sorted_keys)
+    key_bytes = sorted_keys.view(np.uint8).reshape(len(records), key_width)
+    first_byte = np.zeros(256, dtype=np.uint8)
+    first_byte[key_bytes[key_lengths == 1, 0]] = 1
+    first_pair = np.zeros(256 * 256, dtype=np.uint8)
+    if key_width > 1:
+        long_keys = key_bytes[key_lengths > 1]
+        first_pair[long_keys[:, 0].astype(np.int64) * 256 + long_keys[:, 1]] = 1
+    lengths = np.unique(key_lengths).astype("<i8")
+
+    if os.path.isfile(outfilepath):
+        warnings.warn("Overwriting the existing file: %s" % outfilepath)
+    with open(outfilepath, 'wb') as outfile:
+        header = COMPILED_MAP_HEADER.pack(COMPILED_MAP_MAGIC, len(records), key_width, val_width, len(lengths))
+        outfile.write(header.ljust(COMPILED_MAP_HEADER_SIZE, b'\x00'))
+        outfile.write(records[sorted_index].tobytes())
+        outfile.write(order.tobytes())
+        outfile.write(lengths.tobytes())
+        outfile.write(first_byte.tobytes())
+        outfile.write(first_pair.tobytes())
+
+    nested = CompiledReplacementMap(outfilepath).find_nested_key()
+    if nested is not None:
+        os.remove(outfilepath)
+        raise ValueError("Cannot compile %s: the key %r occurs within the %s %r, so the result of the "
+                         "replacement would depend on the order of the keys." % ((filepath,) + nested))
+    return
+
+
+def is_compiled_replacement_file(filepath: str) -> bool:
+    """
+    Check if the file specified by `filepath` is a compiled replacement map
+    by looking for the magic string at the start of the file.
+    """
+    with open(filepath, 'rb') as filehandle:
+        return filehandle.read(len(COMPILED_MAP_MAGIC_PREFIX)) == COMPILED_MAP_MAGIC_PREFIX
+
+
+class CompiledReplacementMap(Mapping):
+    """
+    Read-only string mapping backed by a memory-mapped file written by
+    `compile_string_replacement_file`. Loading only reads the header and the key bitmaps,
+    whatever the size of the map, and the pages are shared by every process mapping the same file.
+    Lookups are binary searches over the sorted keys; iteration follows the
+    line order of the original `replacement_file`.
+
+    Replacement (`replace_string`, `replace_bytes`) scans the data once, working directly on the
+    memory-mapped keys: positions whose first byte pair starts a key are looked up by binary search,
+    once per distinct key length. As no key occurs within another key or a value, this gives the same
+    result as replacing one key after another, except for a key that would only appear
+    across the boundary between a replacement value and its surrounding text.
+    """
+
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as filehandle:
+            header = filehandle.read(COMPILED_MAP_HEADER.size)
+            magic, num_entries, key_width, val_width, num_lengths = COMPILED_MAP_HEADER.unpack(header)
+            if magic != COMPILED_MAP_MAGIC:
+                if magic.startswith(COMPILED_MAP_MAGIC_PREFIX):
+                    raise ValueError("%s was compiled by another version, please recompile it." % filepath)
+                raise ValueError("%s is not a compiled replacement map." % filepath)
+            dtype = np.dtype([("key", f"S{key_width}"), ("val", f"S{val_width}")])
+            filehandle.seek(COMPILED_MAP_HEADER_SIZE + num_entries * (dtype.itemsize + 8))
+            self._lengths = np.frombuffer(filehandle.read(num_lengths * 8), dtype="<i8").tolist()
+            self._first_byte = np.frombuffer(filehandle.read(256), dtype=np.uint8).astype(bool)
+            self._first_pair = np.frombuffer(filehandle.read(256 * 256), dtype=np.uint8).astype(bool)
+        if num_entries == 0:
+            self._records = np.empty(0, dtype=dtype)
+            self._order = np.empty(0, dtype="<i8")
+        else:
+            self._records = np.memmap(filepath, dtype=dtype, mode='r',
+                                      offset=COMPILED_MAP_HEADER_SIZE, shape=(num_entries,))
+            self._order = np.memmap(filepath, dtype="<i8", mode='r',
+                                    offset=COMPILED_MAP_HEADER_SIZE + num_entries * dtype.itemsize,
+                                    shape=(num_entries,))
+        self._keys = self._records["key"]
+        self._values = self._records["val"]
+
+    def __getitem__(self, key):
+        return self._lookup(key.encode("utf-8")).decode("utf-8")
+
+    @property
+    def max_key_length(self):
+        """
+        Length in bytes of the longest key.
+        """
+        return self._lengths[-1] if self._lengths else 0
+
+    def _lookup(self, encoded_key):
+        i = np.searchsorted(self._keys, encoded_key)
+        if i < len(self._keys) and self._keys[i] == encoded_key:
+            return self._values[i]
+        raise KeyError(encoded_key.decode("utf-8"))
+
+    def _find_all(self, data: bytes):
+        """
+        Find every, possibly overlapping, occurrence of a key in `data`.
+
+        :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        Start offsets, lengths and indices in the sorted keys of the occurrences.
+        """
+        text = np.frombuffer(data, dtype=np.uint8)
+        starts, lengths, indices = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], \
+            [np.empty(0, dtype=np.int64)]
+        if len(text) > 1:
+            first_pairs = self._first_pair[(text[:-1].astype(np.uint16) << 8) | text[1:]]
+        for length in self._lengths:
+            if length > len(text):
+                continue
+            if length == 1:
+                candidates = np.flatnonzero(self._first_byte[text])
+            else:
+                candidates = np.flatnonzero(first_pairs[:len(text) - length + 1])
+            if not len(candidates):
+                continue
+            windows = np.lib.stride_tricks.sliding_window_view(text, length)[candidates]
+            needles = windows.view(f"S{length}").ravel().astype(self._keys.dtype)
+            i = np.minimum(np.searchsorted(self._keys, needles), len(self._keys) - 1)
+            # Trailing null bytes are ignored when comparing numpy strings, hence the length check.
+            found = (self._keys[i] == needles) & (np.char.str_len(self._keys[i]) == length)
+            starts.append(candidates[found])
+            lengths.append(np.full(np.count_nonzero(found), length, dtype=np.int64))
+            indices.append(i[found])
+        return np.concatenate(starts), np.concatenate(lengths), np.concatenate(indices)
+
+    def _find(self, data: bytes):
+        """
+        Leftmost, longest, non-overlapping occurrences of keys in `data`.
+
+        :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        Start offsets, end offsets and indices in the sorted keys of the occurrences.
+        """
+        starts, lengths, indices = self._find_all(data)
+        order = np.lexsort((-lengths, starts))
+        starts, ends, indices = starts[order], starts[order] + lengths[order], indices[order]
+        if np.any(starts[1:] < ends[:-1]):
+            keep = []
+            last_end = 0
+            for position, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+                if start >= last_end:
+                    keep.append(position)
+                    last_end = end
+            starts, ends, indices = starts[keep], ends[keep], indices[keep]
+        return starts, ends, indices
+
+    def find(self, data: bytes):
+        """
+        Return the (start, end) offsets of the keys occurring in the UTF-8 encoded `data`,
+        as `replace_bytes` would replace them.
+        """
+        starts, ends, indices = self._find(data)
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def replace_bytes(self, data: bytes) -> bytes:
+        """
+        Replace every occurrence of a key in the UTF-8 encoded `data` with its value.
+        """
+        starts, ends, indices = self._find(data)
+        if not len(starts):
+            return data
+        pieces = [data[:starts[0]]]
+        for value, end, next_start in zip(self._values[indices].tolist(), ends.tolist(),
+                                          starts[1:].tolist() + [len(data)]):
+            pieces.append(value)
+            pieces.append(data[end:next_start])
+        return b''.join(pieces)
+
+    def find_nested_key(self):
+        """
+        Return (key, "key" or "value", container) for a key occurring within another key or
+        within a value, or None if there is no such key.
+        """
+        key_list = self._keys.tolist()
+        segment_starts = np.cumsum([0] + [len(key) + 1 for key in key_list])[:-1]
+        starts, lengths, indices = self._find_all(b'\x00'.join(key_list))
+        # Every key is found at its own position; any other occurrence is nested in another key.
+        nested = np.flatnonzero((starts != segment_starts[indices]) | (lengths != np.char.str_len(self._keys[indices])))
+        if len(nested):
+            container = np.searchsorted(segment_starts, starts[nested[0]], side="right") - 1
+            return key_list[indices[nested[0]]].decode("utf-8"), "key", key_list[container].decode("utf-8")
+        value_list = self._values.tolist()
+        starts, lengths, indices = self._find_all(b'\x00'.join(value_list))
+        if len(starts):
+            segment_starts = np.cumsum([0] + [len(value) + 1 for value in value_list])[:-1]
+            container = np.searchsorted(segment_starts, starts[0], side="right") - 1
+            return key_list[indices[0]].decode("utf-8"), "value", value_list[container].decode("utf-8")
+        return None
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        for key, val in self.items():
+            yield key
+
+    def items(self, block_size=65536):
+        """
+        Lazily decode (key, value) pairs in original line order, one block at a time.
+        """
+        for start in range(0, len(self._order), block_size):
+            for key, val in self._records[self._order[start:start + block_size]]:
+                yield key.decode("utf-8"), val.decode("utf-8")
+
+
 def replace_string(string: str, replacement_dict: dict) -> str:
     """
     Replace all occurrence of the keys of `replacement_dict` in `string` with
@@ -150,11 +531,100 @@ def replace_string(string: str, replacement_dict: dict) -> str:
     :return: String
     Return the processed string.
     """
+    if isinstance(replacement_dict, CompiledReplacementMap):
+        return replacement_dict.replace_bytes(string.encode("utf-8")).decode("utf-8")
     for key, val in replacement_dict.items():
         string = string.replace(key, val)
     return string
 
 
+def build_matcher(keys):
+    """
+    Compile a single regular expression matching any of `keys` in UTF-8 encoded bytes.
+    The keys are arranged as a prefix tree so that matching does not try every key at each position,
+    and longer keys are tried first so that a key is not shadowed by one of its prefixes.
+
+    :param keys: iterable of str
+    The strings to look for.
+
+    :return: re.Pattern
+    """
+    encoded_keys = sorted({key.encode("utf-8") for key in keys if key})
+    if not encoded_keys:
+        raise ValueError("Cannot build a matcher without any key.")
+    return re.compile(_trie_pattern(encoded_keys))
+
+
+def _trie_pattern(sorted_keys, depth=0):
+    """
+    Regular expression pattern matching any of `sorted_keys`, a sorted list of distinct bytes
+    sharing their first `depth` bytes, by branching on their byte at position `depth`.
+    """
+    ends_here = False
+    branches = []
+    leaves = []
+    i = 0
+    while i < len(sorted_keys):
+        if len(sorted_keys[i]) == depth:
+            ends_here = True
+            i += 1
+            continue
+        byte = sorted_keys[i][depth:depth + 1]
+        j = i + 1
+        while j < len(sorted_keys) and sorted_keys[j][depth:depth + 1] == byte:
+            j += 1
+        if j == i + 1:  # the only key with this prefix, no need to branch further
+            remainder = re.escape(sorted_keys[i][depth:])
+            (leaves if len(sorted_keys[i]) == depth + 1 else branches).append(remainder)
+        else:
+            branches.append(re.escape(byte) + _trie_pattern(sorted_keys[i:j], depth + 1))
+        i = j
+    if leaves:
+        branches.append(leaves[0] if len(leaves) == 1 else b'[' + b''.join(leaves) + b']')
+    pattern = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+    if ends_here:  # greedy, so longer keys sharing this prefix are tried first
+        pattern = b'(?:' + pattern + b')?'
+    return pattern
+
+
+def replace_bytes(data: bytes, replacement_dict: dict) -> bytes:
+    """
+    Same as `replace_string` but on UTF-8 encoded bytes.
+    """
+    if isinstance(replacement_dict, CompiledReplacementMap):
+        return replacement_dict.replace_bytes(data)
+    for key, val in replacement_dict.items():
+        data = data.replace(key.encode("utf-8"), val.encode("utf-8"))
+    return data
+
+
+def iter_decompressed_chunks(infile, buffer_size, compressed=False):
+    """
+    Read `infile` opened in binary mode `buffer_size` bytes at a time and yield its content,
+    decompressed if `compressed` is True. Multi-member gzip files, including BGZF,
+    are decompressed member after member.
+    Raise EOFError if the last member is truncated, as `gzip.open` does.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    member_started = False
+    for chunk in iter(lambda: infile.read(buffer_size), b''):
+        if not compressed:
+            yield chunk
+            continue
+        decompressed = []
+        while chunk:
+            decompressed.append(decompressor.decompress(chunk))
+            member_started = True
+            if not decompressor.eof:
+                break
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            member_started = False
+        yield b''.join(decompressed)
+    if compressed and member_started:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+
 def is_gzip(filepath: str) -> bool:
     """
     Check if a the file specified by filepath
@@ -194,26 +664,29 @@ def infile_handler(filepath: str) -> TextIO:
 
 
 def outfile_handler(filepath: str,
-                    compression: Optional[str] = None) -> TextIO:
+                    compression: Optional[str] = None,
+                    binary: bool = False) -> TextIO:
     """
     Return a file handle in write mode using the appropriate
     handle depending on the compression mode.
     Valid compression mode:
         compress = None | "None" | "gzip" | "gz" | "bgzip" | "bgz"
     If compress = None or other input, open the file normally.
+    If binary = True, the handle accepts bytes instead of str.
     """
     if os.path.isfile(filepath):
         warnings.warn("Overwriting the existing file: %s" % filepath)
 
+    mode = "wb" if binary else "wt"
     if compression is None:
-        return open(filepath, mode="wt")
+        return open(filepath, mode=mode)
     elif type(compression) == str:
         if compression.lower() in ["gzip", "gz"]:
-            return gzip.open(filepath, mode="wt")
+            return gzip.open(filepath, mode=mode)
         elif compression.lower() in ["bgzip", "bgz"]:
             return BgzfWriter(filepath)
         elif compression.lower() == "none":
-            return open(filepath, mode="wt")
+            return open(filepath, mode=mode)
     else:
         raise Exception("`compression = %s` invalid." % str(compression))
 
@@ -1,6 +1,10 @@
+import hashlib
+import hmac
 import os
+import secrets
 import string
 import random
+import numpy as np
 from file_replace_string import (
     replace_string,
 )
@@ -66,6 +70,115 @@ def rand_string(n=10):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(n))
 
 
+PSEUDONYM_ALPHABET = string.ascii_uppercase + string.digits
+_ALPHABET_CODES = np.frombuffer(PSEUDONYM_ALPHABET.encode("ascii"), dtype=np.uint8)
+# Largest multiple of the alphabet size below 256. Bytes above it are rejected to avoid modulo bias.
+_REJECTION_BOUND = 256 - 256 % len(PSEUDONYM_ALPHABET)
+MAX_PSEUDONYM_ATTEMPTS = 100
+
+
+def generate_pseudonyms(names, length=16, seed=None, key=None, exclude=(), domain=""):
+    """
+    Generate a unique pseudonym of `length` uppercase letters and digits for each of `names`.
+    By default, random pseudonyms are drawn from a CSPRNG (`secrets`) in one batch.
+    For reproducible reruns, either
+      - `seed` : draw from a SHAKE-256 stream seeded by `seed`, or
+      - `key`  : derive each pseudonym from HMAC-SHA256(`key`, name), so that a name gets the same
+                 pseudonym in every run regardless of which other names are present.
+    Pseudonyms colliding with each other or with `exclude` are redrawn, checking uniqueness with a set.
+
+    :param names: iterable of str
+    The strings to be pseudonymised. Duplicates are ignored.
+
+    :param length: int
+    Length of each pseudonym.
+
+    :param seed: str
+    Seed for the deterministic random mode.
+
+    :param key: bytes
+    Secret key for the deterministic keyed mode.
+
+    :param exclude: iterable of str
+    Strings pseudonyms must not be equal to, e.g. existing IDs.
+
+    :param domain: str
+    Mixed into the seed or key so that different kinds of names get independent pseudonyms.
+
+    :return: dict
+    Mapping from name to pseudonym.
+    """
+    if seed is not None and key is not None:
+        raise ValueError("Only one of `seed` and `key` can be specified.")
+    if length < 1:
+        raise ValueError(f"Pseudonym length must be at least 1, got {length}.")
+    names = sorted(set(names))  # sorted so that seeded runs do not depend on input order
+    taken = set(exclude)
+    num_taken = sum(1 for name in taken if len(name) == length and set(name) <= set(PSEUDONYM_ALPHABET))
+    if len(names) + num_taken > len(PSEUDONYM_ALPHABET) ** length:
+        raise ValueError(f"Not enough pseudonyms of length {length} for {len(names)} names.")
+
+    pseudonyms = {}
+    pending = names
+    for attempt in range(MAX_PSEUDONYM_ATTEMPTS):
+        if not pending:
+            break
+        if key is not None:
+            candidates = [
+                _keyed_pseudonym(key, f"{domain}\0{name}\0{attempt}".encode("utf-8"), length) for name in pending
+            ]
+        else:
+            candidates = _random_pseudonyms(len(pending), length, seed=seed, salt=f"{domain}\0{attempt}")
+        collided = []
+        for name, candidate in zip(pending, candidates):
+            if candidate in taken:
+                collided.append(name)
+            else:
+                taken.add(candidate)
+                pseudonyms[name] = candidate
+        pending = collided
+    if pending:
+        raise RuntimeError(f"Could not generate unique pseudonyms for {len(pending)} names "
+                           f"in {MAX_PSEUDONYM_ATTEMPTS} attempts. Consider a longer pseudonym length.")
+    return pseudonyms
+
+
+def _random_pseudonyms(num, length, seed=None, salt=""):
+    """
+    Draw `num` random strings of `length` characters from `PSEUDONYM_ALPHABET` in one vectorised pass,
+    using `secrets` if `seed` is None or a SHAKE-256 stream of `seed` and `salt` otherwise.
+    """
+    needed = num * length
+    accepted = np.empty(0, dtype=np.uint8)
+    draw = 0
+    while len(accepted) < needed:
+        num_bytes = (needed - len(accepted)) * 256 // _REJECTION_BOUND + 64
+        if seed is None:
+            random_bytes = secrets.token_bytes(num_bytes)
+        else:
+            random_bytes = hashlib.shake_256(f"{seed}\0{salt}\0{draw}".encode("utf-8")).digest(num_bytes)
+        codes = np.frombuffer(random_bytes, dtype=np.uint8)
+        accepted = np.concatenate([accepted, codes[codes < _REJECTION_BOUND]])
+        draw += 1
+    chars = _ALPHABET_CODES[accepted[:needed] % len(PSEUDONYM_ALPHABET)]
+    return chars.view(f"S{length}").astype(str).tolist()
+
+
+def _keyed_pseudonym(key, message, length):
+    """
+    Derive a string of `length` characters from `PSEUDONYM_ALPHABET` from HMAC-SHA256(`key`, `message`).
+    Enough HMAC blocks are concatenated to leave 64 spare bits, making the modulo bias negligible.
+    """
+    num_blocks = (length * 6 + 64) // 256 + 1
+    digest = b''.join(hmac.new(key, message + bytes([i]), hashlib.sha256).digest() for i in range(num_blocks))
+    value = int.from_bytes(digest, "big")
+    chars = []
+    for _ in range(length):
+        value, remainder = divmod(value, len(PSEUDONYM_ALPHABET))
+        chars.append(PSEUDONYM_ALPHABET[remainder])
+    return ''.join(chars)
+
+
 def get_sed_cmd_string(replacement_dict):
     # safely decide on a punctuation sed command separator
     allchar = set(''.join(list(replacement_dict.keys()) + list(replacement_dict.values())))
@@ -3,17 +3,36 @@ import os
 import shlex
 import subprocess
 from file_replace_string import (
-    read_string_replacement_file
+    CompiledReplacementMap,
+    read_string_replacement_file,
+    compile_string_replacement_file
 )
 from generate_commands import (
     generate_commands,
-    rand_string,
+    generate_pseudonyms,
     generate_new_filename,
     fastq_cmd,
     bam_cmd,
     textfile_cmd
 )
+from verify_outputs import (
+    MD5_MISMATCH,
+    UNREADABLE,
+    init_worker,
+    scan_file,
+    list_output_files,
+    keys_from_fileinfo
+)
 from multiprocess_handling import dumb_scheduler, cmd_runner
+from runtime_planner import (
+    DEFAULT_CACHE_FILE,
+    jobs_from_fileinfo,
+    jobs_from_command_list,
+    measure_throughputs,
+    predict_job,
+    simulate_schedule,
+    free_disk_space
+)
 import logging
 import sys
 import pandas as pd
@@ -36,6 +55,7 @@ def subcommand(args=()):
         for arg in args:
             parser.add_argument(*arg[0], **arg[1])
         parser.set_defaults(func=func)
+        return func
 
     return decorator
 
@@ -92,6 +112,13 @@ OUTPUT_COMMAND_ARGS = [
     argument('--anon_strlength', metavar="LENGTH", type=int, required=False,
              default=16,
              help='Length of anonymised ID. Default: 16'),
+    argument('--anon_seed', metavar="SEED", type=str, required=False,
+             help='If specified, anonymised IDs are generated deterministically from this seed '
+                  'so that reruns on the same fileinfo give the same IDs.'),
+    argument('--anon_key_file', metavar="PATH", type=str, required=False,
+             help='Path to a file containing a secret key. If specified, each anonymised ID is derived '
+                  'from the HMAC of the original ID with this key, so it is the same in every run. '
+                  'Cannot be used with --anon_seed.'),
 ]
 
 RUN_COMMAND_ARGS = [
@@ -109,6 +136,68 @@ RUN_COMMAND_ARGS = [
              help="A file to store log outputs.")
 ]
 
+COMPILE_REPLACEMENT_ARGS = [
+    argument('--replacement_file', metavar="PATH", type=str, required=True,
+             help="Path to a 2 column TSV-file containing the original string in the first column "
+                  "and their corresponding replacement string in the second column."),
+    argument('--outfilepath', metavar="PATH", type=str, required=True,
+             help='Path to the compiled replacement map. Existing file will be overwritten.'),
+]
+
+PLAN_ARGS = [
+    argument('--fileinfo', metavar="PATH", type=str, required=False,
+             help='Path to tsv-file of file information as used by `output_command`. '
+                  'Exactly one of --fileinfo and --commandfilepath must be specified.'),
+    argument('--commandfilepath', metavar="PATH", type=str, required=False,
+             help="Path to a list of commands generated by `prepare` or `output_command`."),
+    argument('--outdir', metavar="PATH", type=str, required=False,
+             help='Output directory the commands write into. Used to measure write throughput '
+                  'and check free disk space.'),
+    argument('--multiprocessing', metavar="THREADS", type=int, required=False,
+             default=1,
+             help="Number of processes `run_command` will be run with. Default: 1"),
+    argument('--use_symlink', action="store_true",
+             help="With --fileinfo, plan for fastq files being symlinked instead of copied."),
+    argument('--generate_md5', action="store_true",
+             help="With --fileinfo, plan for md5 being generated for files with content changed."),
+    argument('--anon_strlength', metavar="LENGTH", type=int, required=False,
+             default=16,
+             help='With --fileinfo, length of anonymised ID `output_command` will be run with. Default: 16'),
+    argument('--sample_mb', metavar="MB", type=int, required=False,
+             default=4,
+             help="Megabytes sampled from one file of each type to measure throughput. Default: 4"),
+    argument('--cache_file', metavar="PATH", type=str, required=False,
+             default=DEFAULT_CACHE_FILE,
+             help=f"File caching measured throughputs. Default: {DEFAULT_CACHE_FILE}"),
+    argument('--refresh_cache', action="store_true",
+             help="If specified, remeasure throughputs instead of using cached values."),
+    argument('--outfilepath', metavar="PATH", type=str, required=False,
+             help='If specified, per-job predictions are written to this tsv-file.'),
+]
+
+VERIFY_ARGS = [
+    argument('--fileinfo', metavar="PATH", type=str, required=False,
+             help='Path to tsv-file of file information given to `output_command`. Its sample_id and '
+                  'replacements are the original strings to look for. '
+                  'Exactly one of --fileinfo and --replacement_file must be specified.'),
+    argument('--replacement_file', metavar="PATH", type=str, required=False,
+             help="Path to the replacement file given to `prepare`, "
+                  "whose first column holds the original strings to look for."),
+    argument('--outdir', metavar="PATH", type=str, required=True,
+             help='Output directory to verify. All files under it are scanned.'),
+    argument('--multiprocessing', metavar="THREADS", type=int, required=False,
+             default=1,
+             help="Number of processes used to scan files. Default: 1"),
+    argument('--follow_symlinks', action="store_true",
+             help="If specified, symlinked files are scanned as well. They are skipped by default "
+                  "since they point at unmodified input."),
+    argument('--max_hits', type=int, required=False,
+             default=100,
+             help="Maximum number of residual strings reported per file. Default: 100"),
+    argument('--outfilepath', metavar="PATH", type=str, required=False,
+             help='If specified, residual strings are written to this tsv-file instead of stdout.'),
+]
+
 
 #############
 # Subcommands
@@ -163,12 +252,27 @@ def output_command(args):
     anon_batch = args.anon_batch
     df_fileinfo = pd.read_csv(args.fileinfo, sep='\t', dtype=str)
     outdirpath = os.path.abspath(args.outdir)
-    replacement_dict = {
-        s: rand_string(n=args.anon_strlength) for s in set(df_fileinfo["sample_id"])
-    }
-    batch_mapping = {
-        batch: rand_string(n=args.anon_strlength) for batch in set(df_fileinfo["batch"])
-    }
+    anon_key = None
+    if args.anon_key_file is not None:
+        with open(args.anon_key_file, 'rb') as keyfile:
+            anon_key = keyfile.read().strip()
+    existing_ids = set(df_fileinfo["sample_id"]) | set(df_fileinfo["batch"])
+    replacement_dict = generate_pseudonyms(
+        df_fileinfo["sample_id"],
+        length=args.anon_strlength,
+        seed=args.anon_seed,
+        key=anon_key,
+        exclude=existing_ids,
+        domain="sample_id"
+    )
+    batch_mapping = generate_pseudonyms(
+        df_fileinfo["batch"],
+        length=args.anon_strlength,
+        seed=args.anon_seed,
+        key=anon_key,
+        exclude=existing_ids | set(replacement_dict.values()),
+        domain="batch"
+    )
 
     cmd_list = []
     for i, row in df_fileinfo.iterrows():
@@ -262,6 +366,126 @@ def run_command(args):
     return
 
 
+@subcommand(COMPILE_REPLACEMENT_ARGS)
+def compile_replacement(args):
+    """
+    Compile a replacement TSV-file into a read-only binary map that is memory-mapped and shared by
+    all worker processes. The compiled file can be passed wherever a --replacement_file is expected.
+    Maps where a key occurs within another key or a value are refused.
+    """
+    compile_string_replacement_file(args.replacement_file, args.outfilepath)
+    return
+
+
+@subcommand(PLAN_ARGS)
+def plan(args):
+    """
+    Estimate the runtime, peak concurrent disk writes and output footprint of a run
+    before executing it, by sampling each file type to measure local throughput.
+    """
+    if (args.fileinfo is None) == (args.commandfilepath is None):
+        raise ValueError("Exactly one of --fileinfo and --commandfilepath must be specified.")
+    if args.fileinfo is not None:
+        df_fileinfo = pd.read_csv(args.fileinfo, sep='\t', dtype=str)
+        jobs = jobs_from_fileinfo(df_fileinfo, use_symlink=args.use_symlink, generate_md5=args.generate_md5,
+                                  anon_strlength=args.anon_strlength)
+    else:
+        jobs = jobs_from_command_list(args.commandfilepath)
+
+    throughputs = measure_throughputs(
+        jobs,
+        outdir=args.outdir,
+        sample_mb=args.sample_mb,
+        cache_file=args.cache_file,
+        refresh_cache=args.refresh_cache
+    )
+    predicted_jobs = [predict_job(job, throughputs) for job in jobs]
+    wall_time, peak_writers, peak_write_rate = simulate_schedule(predicted_jobs, num_process=args.multiprocessing)
+    total_input = sum(job["input_size"] for job in predicted_jobs)
+    total_output = sum(job["output_size"] for job in predicted_jobs)
+
+    if args.outfilepath is not None:
+        with open(args.outfilepath, 'w') as outfile:
+            outfile.write("filepath\tkind\tinput_bytes\toutput_bytes\tseconds\n")
+            for job in predicted_jobs:
+                outfile.write(f"{job['filepath']}\t{job['kind']}\t{job['input_size']}\t"
+                              f"{job['output_size']}\t{job['seconds']:.1f}\n")
+
+    gib = 1024 ** 3
+    print(f"Number of jobs              : {len(predicted_jobs)}")
+    print(f"Total input size            : {total_input / gib:.2f} GiB")
+    print(f"Predicted output footprint  : {total_output / gib:.2f} GiB")
+    print(f"Serial CPU time             : {sum(job['seconds'] for job in predicted_jobs) / 3600:.2f} hours")
+    print(f"Predicted wall time         : {wall_time / 3600:.2f} hours with {args.multiprocessing} process(es)")
+    print(f"Peak concurrent writers     : {peak_writers}")
+    print(f"Peak aggregate write rate   : {peak_write_rate / 1024 ** 2:.1f} MiB/s "
+          f"(measured local write rate: {throughputs['io']['write'] / 1024 ** 2:.1f} MiB/s)")
+    if args.outdir is not None:
+        free_space = free_disk_space(args.outdir)
+        print(f"Free space in --outdir      : {free_space / gib:.2f} GiB")
+        if free_space < total_output:
+            logging.warning(f"WARNING: Predicted output footprint exceeds free space in {args.outdir}.")
+    return
+
+
+@subcommand(VERIFY_ARGS)
+def verify(args):
+    """
+    Scan every output file in parallel for residual original strings, decompressing gzip, BGZF and BAM files,
+    and check files against their `.md5` sidecars.
+    Exit with non-zero status on any leak, md5 mismatch or unreadable file.
+    """
+    if (args.fileinfo is None) == (args.replacement_file is None):
+        raise ValueError("Exactly one of --fileinfo and --replacement_file must be specified.")
+    if args.fileinfo is not None:
+        keys = keys_from_fileinfo(pd.read_csv(args.fileinfo, sep='\t', dtype=str))
+    else:
+        keys = read_string_replacement_file(args.replacement_file)
+    if isinstance(keys, CompiledReplacementMap):
+        # Workers memory-map the compiled file and search its keys directly.
+        num_keys = len(keys)
+        initargs = (None, args.replacement_file)
+    else:
+        keys = sorted(key for key in keys if isinstance(key, str) and key)
+        num_keys = len(keys)
+        initargs = (keys,)
+    if not num_keys:
+        raise ValueError("No original strings to look for were found in "
+                         f"{args.fileinfo if args.fileinfo is not None else args.replacement_file}.")
+    filelist = list_output_files(args.outdir, follow_symlinks=args.follow_symlinks)
+    params = [(filepath, reportpath, args.max_hits) for filepath, reportpath in filelist]
+
+    num_leaked_files = 0
+    md5_mismatches = []
+    unreadable_files = []
+    outfile = open(args.outfilepath, 'w') if args.outfilepath is not None else sys.stdout
+    outfile.write("filepath\toffset\tresidual_string\n")
+    with Pool(processes=max(args.multiprocessing, 1), initializer=init_worker, initargs=initargs) as pool:
+        for reportpath, hits, md5_status in pool.imap_unordered(scan_file, params):
+            if hits:
+                num_leaked_files += 1
+            for key, offset in hits:
+                outfile.write(f"{reportpath}\t{offset}\t{key}\n")
+            if md5_status == MD5_MISMATCH:
+                md5_mismatches.append(reportpath)
+            elif md5_status == UNREADABLE:
+                unreadable_files.append(reportpath)
+    if outfile is not sys.stdout:
+        outfile.close()
+
+    print(f"Scanned {len(params)} files for {num_keys} original strings.", file=sys.stderr)
+    print(f"Files with residual strings : {num_leaked_files}", file=sys.stderr)
+    print(f"Files with md5 mismatch     : {len(md5_mismatches)}", file=sys.stderr)
+    print(f"Unreadable files            : {len(unreadable_files)}", file=sys.stderr)
+    for reportpath in md5_mismatches:
+        print(f"md5 mismatch: {reportpath}", file=sys.stderr)
+    for reportpath in unreadable_files:
+        print(f"Unreadable (corrupt or truncated): {reportpath}", file=sys.stderr)
+    if num_leaked_files or md5_mismatches or unreadable_files:
+        sys.exit(1)
+    return
+
+
 def worker(param):
     proc_rc = subprocess.call(param[0], shell=True, executable='/bin/bash')
     if proc_rc != 0:
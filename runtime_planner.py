@@ -0,0 +1,490 @@
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import shlex
+import shutil
+import socket
+import string
+import subprocess
+import tempfile
+import time
+import zlib
+from file_replace_string import (
+    is_gzip,
+    read_string_replacement_file,
+    replace_bytes,
+    replace_string_in_file
+)
+from generate_commands import get_sed_cmd_string
+
+# Job kinds recognised by the planner.
+LINK = "link"
+COPY = "copy"
+TEXT = "text"
+TEXT_GZ = "text_gz"
+BAM = "bam"
+REPLACE_STRING = "replace_string"  # the `replace_string` entry point generated by `prepare`
+
+DEFAULT_CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "genomic_file_string_replacement", "throughput.json"
+)
+PLACEHOLDER_MAP = {"PLACEHOLDER_SAMPLE_ID": "ANONYMISEDSAMPLE"}
+RATIO_SAMPLE_BYTES = 1024 * 1024
+# Number of the largest inputs of each kind whose ratios are sampled; the others reuse their average.
+RATIO_SAMPLE_FILES = 8
+
+
+########################################################################################################
+# Job collection
+########################################################################################################
+
+
+def jobs_from_fileinfo(df_fileinfo, use_symlink=False, generate_md5=False, anon_strlength=16):
+    """
+    Build the list of jobs `output_command` would generate from a fileinfo table.
+    Sample IDs are mapped to a placeholder of the length of the anonymised IDs.
+
+    :param df_fileinfo: pandas.DataFrame
+    Table with columns filepath, filetype, batch, sample_id and optionally replacements.
+
+    :param use_symlink: bool
+    Whether fastq files would be symlinked instead of copied.
+
+    :param generate_md5: bool
+    Whether an md5 sidecar would be generated for files with changed content.
+
+    :param anon_strlength: int
+    Length of the anonymised IDs.
+
+    :return: list of dict
+    """
+    jobs = []
+    for i, row in df_fileinfo.iterrows():
+        filetype = row["filetype"]
+        infilepath = row["filepath"]
+        string_map = {row["sample_id"]: "X" * anon_strlength}
+        if "replacements" in row.keys() and isinstance(row["replacements"], str):
+            for pair in row["replacements"].split(','):
+                key, val = pair.split(':')
+                string_map[key] = val
+        if filetype == "fastq":
+            kind = LINK if use_symlink else COPY
+        elif filetype == "bam":
+            kind = BAM
+        else:
+            kind = TEXT_GZ if infilepath.endswith(".gz") else TEXT
+        jobs.append({
+            "filepath": infilepath,
+            "kind": kind,
+            "md5": generate_md5 and filetype != "fastq",
+            "string_map": string_map,
+        })
+    return jobs
+
+
+def jobs_from_command_list(commandfilepath):
+    """
+    Recover the list of jobs from a command list generated by `prepare` or `output_command`.
+    The input file of each command is taken to be the first token that is an existing path,
+    or the value of --infilepath for `replace_string` commands, whose --replacement_file is loaded
+    so that they are measured with the real replacement map. Likewise, the `sed` expressions of
+    other commands are parsed back into their replacement map.
+
+    :param commandfilepath: str
+    Path to the command list.
+
+    :return: list of dict
+    """
+    replacement_maps = {}
+    jobs = []
+    with open(commandfilepath) as infile:
+        for line in infile:
+            line = line.strip()
+            if not line:
+                continue
+            # Drop the `mkdir -p` prefix tagged on by `output_command`.
+            main_cmd = line.split(';', 1)[1].strip() if line.startswith("mkdir ") else line
+            tokens = shlex.split(main_cmd.replace('<(', ' ').replace(')', ' '))
+            job = {"md5": "md5sum" in line, "string_map": PLACEHOLDER_MAP}
+            if tokens and tokens[0] == "replace_string":
+                options = dict(zip(tokens[1::2], tokens[2::2]))
+                job["filepath"] = options["--infilepath"]
+                replacement_file = options["--replacement_file"]
+                if replacement_file not in replacement_maps:
+                    replacement_maps[replacement_file] = read_string_replacement_file(replacement_file)
+                job["string_map"] = replacement_maps[replacement_file]
+                job["replacement_file"] = replacement_file
+                if job["filepath"].endswith(".bam"):
+                    job["kind"] = BAM
+                else:
+                    job["kind"] = REPLACE_STRING
+                    job["compress_output"] = "gz" in options["--outfilepath"].lower()
+                jobs.append(job)
+                continue
+            infilepath = next((tok for tok in tokens if os.path.isfile(tok)), None)
+            if infilepath is None:
+                continue
+            job["string_map"] = _sed_string_map(tokens) or PLACEHOLDER_MAP
+            if main_cmd.startswith("ln -s"):
+                kind = LINK
+            elif main_cmd.startswith("cp "):
+                kind = COPY
+            elif "samtools" in main_cmd or infilepath.endswith(".bam"):
+                kind = BAM
+            elif infilepath.endswith(".gz"):
+                kind = TEXT_GZ
+            else:
+                kind = TEXT
+            jobs.append(dict(job, filepath=infilepath, kind=kind))
+    return jobs
+
+
+def _sed_string_map(tokens):
+    """
+    Recover the string mapping from the `s<sep>key<sep>value<sep>g` expressions written by `get_sed_cmd_string`.
+    """
+    string_map = {}
+    for token in tokens:
+        if len(token) < 4 or token[0] != 's' or token[1] not in string.punctuation:
+            continue
+        fields = token[2:].split(token[1])
+        if len(fields) == 3 and fields[2] == 'g' and fields[0]:
+            string_map[fields[0]] = fields[1]
+    return string_map
+
+
+########################################################################################################
+# Throughput measurement
+########################################################################################################
+
+
+def _timed_pipe(cmd, data):
+    """
+    Pipe `data` through the shell command `cmd` and return (output, elapsed seconds).
+    Non-zero return codes are tolerated since sampled compressed input is truncated.
+    """
+    start = time.perf_counter()
+    process = subprocess.run(cmd, shell=True, input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return process.stdout, max(time.perf_counter() - start, 1e-6)
+
+
+def _read_sample(filepath, sample_bytes):
+    """
+    Return the first `sample_bytes` of `filepath`, decompressed if it is gzip-compressed
+    (truncation of the sample is ignored), along with the number of bytes read.
+    """
+    with open(filepath, 'rb') as infile:
+        raw = infile.read(sample_bytes)
+    if not is_gzip(filepath):
+        return raw, len(raw)
+    plain = []
+    while raw:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            plain.append(decompressor.decompress(raw))
+        except zlib.error:
+            break
+        raw = decompressor.unused_data
+    return b''.join(plain), sample_bytes
+
+
+def throughput_key(job):
+    """
+    Key of the cached throughput measurement applying to `job`.
+    """
+    if job["kind"] == REPLACE_STRING:
+        stat = os.stat(job["replacement_file"])
+        return f"{REPLACE_STRING}:{os.path.abspath(job['replacement_file'])}:{stat.st_size}:{stat.st_mtime}:" \
+               f"{is_gzip(job['filepath'])}:{job['compress_output']}"
+    return f"{job['kind']}:{len(job['string_map'])}"
+
+
+def measure_content_throughput(filepath, kind, string_map, sample_bytes):
+    """
+    Sample the first `sample_bytes` of `filepath` and time each stage of the command
+    that would process it: decompression, `sed` replacement and `gzip` compression.
+    BAM files are treated as BGZF-compressed text, which approximates the samtools round-trip.
+
+    :return: dict
+    Throughputs in uncompressed bytes per second.
+    """
+    with open(filepath, 'rb') as infile:
+        raw = infile.read(sample_bytes)
+    if kind in (TEXT_GZ, BAM):
+        plain, decompress_time = _timed_pipe("gzip -cd", raw)
+    else:
+        plain, decompress_time = raw, None
+    plain = plain or b'\n'
+    _, replace_time = _timed_pipe(get_sed_cmd_string(string_map), plain)
+    _, compress_time = _timed_pipe("gzip -c", plain)
+    return {
+        "decompress": len(plain) / decompress_time if decompress_time else None,
+        "replace": len(plain) / replace_time,
+        "compress": len(plain) / compress_time,
+    }
+
+
+def measure_replace_string_throughput(filepath, replacement_dict, compress_output, sample_bytes):
+    """
+    Time `replace_string_in_file`, the pipeline run by `replace_string`, with the real
+    replacement map on a copy of the first `sample_bytes` of `filepath`. The one-off cost of
+    preparing the map for replacement, e.g. building the matcher of a TSV map, is timed separately.
+
+    :return: dict
+    Per-job startup seconds and throughput of the whole pipeline in uncompressed bytes per second.
+    """
+    plain, _ = _read_sample(filepath, sample_bytes)
+    plain = plain or b'\n'
+    start = time.perf_counter()
+    replace_bytes(b'', replacement_dict)
+    startup = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sample_path = os.path.join(tmpdir, "sample")
+        with open(sample_path, 'wb') as samplefile:
+            samplefile.write(gzip.compress(plain) if is_gzip(filepath) else plain)
+        start = time.perf_counter()
+        replace_string_in_file(sample_path, os.path.join(tmpdir, "out.gz" if compress_output else "out"),
+                               replacement_dict)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+    return {"startup": startup, "pipeline": len(plain) / elapsed}
+
+
+def measure_compression_ratio(filepath, string_map, sample_bytes=RATIO_SAMPLE_BYTES):
+    """
+    Estimate from the first `sample_bytes` of `filepath` how much it expands when decompressed
+    (`ratio`), how the size of its decompressed content changes once the strings of `string_map`
+    are replaced (`replace_ratio`) and once the replaced content is gzip-compressed (`output_ratio`).
+    Both of the latter are relative to the decompressed input.
+    """
+    plain, consumed = _read_sample(filepath, sample_bytes)
+    stat = os.stat(filepath)
+    plain = plain or b'\n'
+    replaced = replace_bytes(plain, string_map)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "ratio": len(plain) / max(min(consumed, stat.st_size), 1),
+        "replace_ratio": len(replaced) / len(plain),
+        "output_ratio": len(zlib.compress(replaced, 6)) / len(plain),
+    }
+
+
+def _string_map_signature(job):
+    """
+    Identify the replacement map of `job`, so that cached ratios are remeasured when it changes:
+    the replacement file it was read from, or else a digest of the map.
+    """
+    if "replacement_file" in job:
+        stat = os.stat(job["replacement_file"])
+        return f"{os.path.abspath(job['replacement_file'])}:{stat.st_size}:{stat.st_mtime}"
+    digest = hashlib.md5()
+    for key, val in job["string_map"].items():
+        digest.update(f"{key}\t{val}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def measure_write_throughput(outdir, sample_bytes):
+    """
+    Time writing and fsync-ing `sample_bytes` into `outdir`, as well as md5-ing them.
+    """
+    data = os.urandom(sample_bytes)
+    directory = outdir if outdir is not None and os.path.isdir(outdir) else None
+    with tempfile.NamedTemporaryFile(dir=directory) as tmpfile:
+        start = time.perf_counter()
+        tmpfile.write(data)
+        tmpfile.flush()
+        os.fsync(tmpfile.fileno())
+        write_time = max(time.perf_counter() - start, 1e-6)
+    start = time.perf_counter()
+    hashlib.md5(data).hexdigest()
+    md5_time = max(time.perf_counter() - start, 1e-6)
+    return {"write": sample_bytes / write_time, "md5": sample_bytes / md5_time}
+
+
+def mount_point(path):
+    """
+    Mount point of the filesystem holding `path`, or its closest existing ancestor.
+    """
+    path = os.path.abspath(path if path is not None else tempfile.gettempdir())
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def load_throughput_cache(cache_file):
+    """
+    Return the cached throughputs measured on this host, or an empty dict.
+    """
+    if cache_file is None or not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file) as infile:
+        cache = json.load(infile)
+    return cache.get(socket.gethostname(), {})
+
+
+def save_throughput_cache(cache_file, throughputs):
+    """
+    Store the throughputs measured on this host, keeping entries of other hosts.
+    """
+    if cache_file is None:
+        return
+    cache = {}
+    if os.path.isfile(cache_file):
+        with open(cache_file) as infile:
+            cache = json.load(infile)
+    cache[socket.gethostname()] = throughputs
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with open(cache_file, 'w') as outfile:
+        json.dump(cache, outfile, indent=2)
+
+
+def measure_throughputs(jobs, outdir=None, sample_mb=4, cache_file=DEFAULT_CACHE_FILE, refresh_cache=False,
+                        ratio_sample_files=RATIO_SAMPLE_FILES):
+    """
+    Measure the throughput of each kind of job in `jobs` on a sample of the first file of that kind,
+    the size ratios (see `measure_compression_ratio`) of the `ratio_sample_files` largest inputs of that kind
+    and the write throughput of the filesystem holding `outdir`. The remaining inputs of a kind are given
+    the size-weighted average of the sampled ratios, so that planning does not read every input.
+    Measurements are cached in `cache_file` so that repeated plans do not resample:
+      - processing throughputs by kind and replacement map (see `throughput_key`),
+      - write throughputs by mount point,
+      - size ratios by input path, invalidated when the input, its size or modification time,
+        or its replacement map changes.
+
+    :return: dict
+    The measurements, with the write throughput for `outdir` under "io"
+    and the size ratios of every input path under "ratios".
+    """
+    throughputs = {} if refresh_cache else load_throughput_cache(cache_file)
+    sample_bytes = sample_mb * 1024 * 1024
+    updated = False
+    jobs_by_key = {}
+    for job in jobs:
+        if job["kind"] in (LINK, COPY):
+            continue
+        key = throughput_key(job)
+        jobs_by_key.setdefault(key, []).append(job)
+        if key not in throughputs:
+            if job["kind"] == REPLACE_STRING:
+                throughputs[key] = measure_replace_string_throughput(
+                    job["filepath"], job["string_map"], job["compress_output"], sample_bytes
+                )
+            else:
+                throughputs[key] = measure_content_throughput(
+                    job["filepath"], job["kind"], job["string_map"], sample_bytes
+                )
+            updated = True
+
+    ratios = {}
+    for key, key_jobs in jobs_by_key.items():
+        sizes = {job["filepath"]: os.path.getsize(job["filepath"]) for job in key_jobs}
+        sampled_jobs = sorted(key_jobs, key=lambda job: sizes[job["filepath"]], reverse=True)[:ratio_sample_files]
+        for job in sampled_jobs:
+            ratio_key = f"ratio:{os.path.abspath(job['filepath'])}"
+            stat = os.stat(job["filepath"])
+            cached_ratio = throughputs.get(ratio_key)
+            signature = _string_map_signature(job)
+            if cached_ratio is None or cached_ratio.get("string_map") != signature \
+                    or (cached_ratio["size"], cached_ratio["mtime"]) != (stat.st_size, stat.st_mtime):
+                throughputs[ratio_key] = dict(measure_compression_ratio(job["filepath"], job["string_map"]),
+                                              string_map=signature)
+                updated = True
+            ratios[os.path.abspath(job["filepath"])] = throughputs[ratio_key]
+        total_size = max(sum(sizes[job["filepath"]] for job in sampled_jobs), 1)
+        average_ratio = {
+            name: sum(ratios[os.path.abspath(job["filepath"])][name] * sizes[job["filepath"]]
+                      for job in sampled_jobs) / total_size
+            for name in ["ratio", "replace_ratio", "output_ratio"]
+        }
+        for job in key_jobs:
+            ratios.setdefault(os.path.abspath(job["filepath"]), average_ratio)
+
+    io_key = f"io:{mount_point(outdir)}"
+    if io_key not in throughputs:
+        throughputs[io_key] = measure_write_throughput(outdir, sample_bytes)
+        updated = True
+    if updated:
+        save_throughput_cache(cache_file, throughputs)
+    return dict(throughputs, io=throughputs[io_key], ratios=ratios)
+
+
+########################################################################################################
+# Prediction
+########################################################################################################
+
+
+def predict_job(job, throughputs):
+    """
+    Predict the wall time and output footprint of a single job. Stages of a shell pipeline, as well as of
+    `replace_string_in_file`, run concurrently so a job takes as long as its slowest stage,
+    plus the md5 pass if requested.
+
+    :return: dict
+    The job updated with `input_size`, `output_size` and `seconds`.
+    """
+    input_size = os.path.getsize(job["filepath"])
+    io = throughputs["io"]
+    if job["kind"] == LINK:
+        output_size, seconds = 0, 0.0
+    elif job["kind"] == COPY:
+        output_size = input_size
+        seconds = input_size / io["write"]
+    else:
+        tp = throughputs[throughput_key(job)]
+        ratios = throughputs["ratios"][os.path.abspath(job["filepath"])]
+        plain_size = input_size * ratios["ratio"]
+        if job["kind"] == REPLACE_STRING:
+            output_size = plain_size * ratios["output_ratio" if job["compress_output"] else "replace_ratio"]
+            stage_times = [tp["startup"] + plain_size / tp["pipeline"]]
+        elif job["kind"] == TEXT:
+            output_size = plain_size * ratios["replace_ratio"]
+            stage_times = [plain_size / tp["replace"]]
+        else:
+            output_size = plain_size * ratios["output_ratio"]
+            stage_times = [plain_size / tp["replace"], plain_size / tp["decompress"], plain_size / tp["compress"]]
+        seconds = max(stage_times + [output_size / io["write"]])
+    if job["md5"]:
+        seconds += output_size / io["md5"]
+    return dict(job, input_size=input_size, output_size=int(output_size), seconds=seconds)
+
+
+def simulate_schedule(predicted_jobs, num_process=1):
+    """
+    Greedily assign jobs in order to the first free process, as the `run_command` pool does,
+    and track how many jobs are writing output at the same time.
+
+    :return: (float, int, float)
+    Total wall time, peak number of concurrent writers and peak aggregate write rate (bytes/s).
+    """
+    num_process = max(num_process, 1)
+    workers = [0.0] * num_process
+    events = []
+    for job in predicted_jobs:
+        start = heapq.heappop(workers)
+        end = start + job["seconds"]
+        heapq.heappush(workers, end)
+        if job["output_size"] > 0 and job["seconds"] > 0:
+            rate = job["output_size"] / job["seconds"]
+            events.append((start, 1, rate))
+            events.append((end, -1, -rate))
+    peak_writers, peak_rate, writers, rate = 0, 0.0, 0, 0.0
+    for _, delta, delta_rate in sorted(events):
+        writers += delta
+        rate += delta_rate
+        peak_writers = max(peak_writers, writers)
+        peak_rate = max(peak_rate, rate)
+    return max(workers), peak_writers, peak_rate
+
+
+def free_disk_space(path):
+    """
+    Free bytes on the filesystem holding `path`, or its closest existing ancestor.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
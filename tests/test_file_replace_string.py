@@ -0,0 +1,216 @@
+import errno
+import gzip
+import threading
+
+import pytest
+
+import file_replace_string
+from file_replace_string import (
+    CompiledReplacementMap,
+    build_matcher,
+    compile_string_replacement_file,
+    read_string_replacement_file,
+    replace_string,
+    replace_string_in_file
+)
+
+
+def run_with_timeout(func, timeout=10):
+    """
+    Run `func` in a thread and return its outcome, failing the test if it hangs.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = func()
+        except Exception as error:
+            outcome["error"] = error
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "replace_string_in_file did not return"
+    return outcome
+
+
+def test_replacement_across_buffer_boundaries(tmp_path):
+    infile = tmp_path / "in.txt"
+    outfile = tmp_path / "out.txt"
+    lines = [f"{i}\tSAMPLE1\tSAMPLE10 S2\n" for i in range(200)]
+    infile.write_text(''.join(lines) + "SAMPLE1 without newline")
+    replacement_dict = {"SAMPLE10": "X", "SAMPLE1": "ANON", "S2": "Y"}
+
+    stage_times = replace_string_in_file(str(infile), str(outfile), replacement_dict, buffer_size=7, queue_size=2)
+
+    expected = ''.join(f"{i}\tANON\tX Y\n" for i in range(200)) + "ANON without newline"
+    assert outfile.read_text() == expected
+    assert set(stage_times) == {"reader", "transformer", "writer"}
+    assert all(times["busy"] >= 0 and times["waiting"] >= 0 for times in stage_times.values())
+
+
+def test_multi_member_gzip_to_bgzip(tmp_path):
+    infile = tmp_path / "in.txt.gz"
+    outfile = tmp_path / "out.txt.gz"
+    infile.write_bytes(gzip.compress(b"a SAMPLE1\n") + gzip.compress(b"b SAMPLE1\n"))
+
+    replace_string_in_file(str(infile), str(outfile), {"SAMPLE1": "ANON"}, buffer_size=5)
+
+    assert gzip.decompress(outfile.read_bytes()) == b"a ANON\nb ANON\n"
+
+
+def test_truncated_gzip_raises(tmp_path):
+    infile = tmp_path / "in.txt.gz"
+    compressed = gzip.compress(''.join(f"line {i} SAMPLE1\n" for i in range(10000)).encode())
+    infile.write_bytes(compressed[:len(compressed) // 2])
+
+    outcome = run_with_timeout(
+        lambda: replace_string_in_file(str(infile), str(tmp_path / "out.txt"), {"SAMPLE1": "ANON"}, buffer_size=1024)
+    )
+
+    assert isinstance(outcome.get("error"), EOFError)
+
+
+def test_writer_failing_on_close_does_not_hang(tmp_path, monkeypatch):
+    infile = tmp_path / "in.txt"
+    infile.write_text("SAMPLE1\n" * 1000)
+    original_handler = file_replace_string.outfile_handler
+
+    class FailingOnClose:
+        def __init__(self, handle):
+            self.handle = handle
+
+        def __enter__(self):
+            return self.handle.__enter__()
+
+        def __exit__(self, *exc_info):
+            self.handle.__exit__(*exc_info)
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(file_replace_string, "outfile_handler",
+                        lambda *args, **kwargs: FailingOnClose(original_handler(*args, **kwargs)))
+
+    outcome = run_with_timeout(
+        lambda: replace_string_in_file(str(infile), str(tmp_path / "out.txt"), {"SAMPLE1": "ANON"}, buffer_size=64)
+    )
+
+    assert isinstance(outcome.get("error"), OSError)
+    assert outcome["error"].errno == errno.ENOSPC
+
+
+def test_transformer_failure_does_not_block_reader(tmp_path, monkeypatch):
+    infile = tmp_path / "in.txt"
+    infile.write_text("SAMPLE1\n" * 10000)
+
+    def failing_replace_bytes(data, replacement_dict):
+        raise ValueError("transform failed")
+
+    monkeypatch.setattr(file_replace_string, "replace_bytes", failing_replace_bytes)
+
+    outcome = run_with_timeout(
+        lambda: replace_string_in_file(str(infile), str(tmp_path / "out.txt"), {"SAMPLE1": "ANON"},
+                                       buffer_size=16, queue_size=1)
+    )
+
+    assert isinstance(outcome.get("error"), ValueError)
+
+
+def test_writer_failure_stops_upstream_stages(tmp_path, monkeypatch):
+    infile = tmp_path / "in.txt"
+    infile.write_text("SAMPLE1\n" * 10000)
+    original_replace_bytes = file_replace_string.replace_bytes
+    num_transformed = []
+
+    def counting_replace_bytes(data, replacement_dict):
+        num_transformed.append(len(data))
+        return original_replace_bytes(data, replacement_dict)
+
+    class FailingOnWrite:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def write(self, data):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(file_replace_string, "replace_bytes", counting_replace_bytes)
+    monkeypatch.setattr(file_replace_string, "outfile_handler", lambda *args, **kwargs: FailingOnWrite())
+
+    outcome = run_with_timeout(
+        lambda: replace_string_in_file(str(infile), str(tmp_path / "out.txt"), {"SAMPLE1": "ANON"},
+                                       buffer_size=16, queue_size=1)
+    )
+
+    assert outcome["error"].errno == errno.ENOSPC
+    # 5000 buffers in the file; only those already queued when the writer failed are transformed.
+    assert len(num_transformed) < 10
+
+
+@pytest.fixture
+def compiled_map(tmp_path):
+    tsvfile = tmp_path / "replacement.tsv"
+    tsvfile.write_text("S10\tA\nS2\tBBB\nS31\tC\nS2\tD\nX\tE\n")
+    compiled_path = tmp_path / "replacement.map"
+    compile_string_replacement_file(str(tsvfile), str(compiled_path))
+    return str(tsvfile), str(compiled_path)
+
+
+def test_compiled_map_round_trip(compiled_map):
+    tsvfile, compiled_path = compiled_map
+    replacement_map = read_string_replacement_file(compiled_path)
+
+    assert isinstance(replacement_map, CompiledReplacementMap)
+    assert list(replacement_map.items()) == list(read_string_replacement_file(tsvfile).items())
+    assert len(replacement_map) == 4
+    assert replacement_map["S31"] == "C"
+    assert "S3" not in replacement_map
+    with pytest.raises(KeyError):
+        replacement_map["S3"]
+
+
+def test_compiled_map_matches_tsv(compiled_map):
+    tsvfile, compiled_path = compiled_map
+    string = "xS10yS1zS2 S100 S31S3 XS2X S10S31 \u00e9S2"
+    expected = replace_string(string, read_string_replacement_file(tsvfile))
+
+    assert replace_string(string, read_string_replacement_file(compiled_path)) == expected
+    assert expected == "xAyS1zD A0 CS3 EDE AC \u00e9D"
+
+
+@pytest.mark.parametrize("content", ["S1\tA\nS10\tB\n", "A\tB\nB\tC\n", "S1\tXS1Y\n", "\tA\n"])
+def test_compile_refuses_order_dependent_map(tmp_path, content):
+    tsvfile = tmp_path / "replacement.tsv"
+    tsvfile.write_text(content)
+
+    with pytest.raises(ValueError):
+        compile_string_replacement_file(str(tsvfile), str(tmp_path / "replacement.map"))
+    assert not (tmp_path / "replacement.map").exists()
+
+
+def test_compiled_map_in_pipeline(compiled_map, tmp_path):
+    tsvfile, compiled_path = compiled_map
+    infile = tmp_path / "in.txt"
+    infile.write_text("S31\tS10\n" * 100)
+
+    replace_string_in_file(str(infile), str(tmp_path / "out.txt"), read_string_replacement_file(compiled_path),
+                           buffer_size=5)
+
+    assert (tmp_path / "out.txt").read_text() == "C\tA\n" * 100
+
+
+def test_empty_compiled_map(tmp_path):
+    tsvfile = tmp_path / "empty.tsv"
+    tsvfile.write_text("")
+    compile_string_replacement_file(str(tsvfile), str(tmp_path / "empty.map"))
+    replacement_map = read_string_replacement_file(str(tmp_path / "empty.map"))
+
+    assert len(replacement_map) == 0
+    assert replace_string("S1", replacement_map) == "S1"
+
+
+def test_build_matcher_prefers_longest_key():
+    matcher = build_matcher(["S1", "S10", "S2", "a-]"])
+
+    assert matcher.findall(b"S10 S1 S2 S3 a-] S100") == [b"S10", b"S1", b"S2", b"a-]", b"S10"]
@@ -0,0 +1,47 @@
+import pytest
+
+from generate_commands import generate_pseudonyms
+
+NAMES = [f"SAMPLE{i}" for i in range(50)]
+
+
+@pytest.mark.parametrize("mode", [{}, {"seed": "s"}, {"key": b"k"}])
+def test_pseudonyms_are_unique_and_avoid_exclude(mode):
+    excluded = set(generate_pseudonyms(NAMES, length=2, **mode).values()) if mode else {"AA", "AB"}
+    pseudonyms = generate_pseudonyms(NAMES, length=2, exclude=excluded, **mode)
+
+    assert sorted(pseudonyms) == sorted(NAMES)
+    assert len(set(pseudonyms.values())) == len(NAMES)
+    assert not set(pseudonyms.values()) & excluded
+    assert all(len(pseudonym) == 2 and pseudonym.isalnum() for pseudonym in pseudonyms.values())
+
+
+def test_seeded_pseudonyms_do_not_depend_on_input_order():
+    assert generate_pseudonyms(NAMES, seed="s") == generate_pseudonyms(reversed(NAMES), seed="s")
+    assert generate_pseudonyms(NAMES, seed="s") != generate_pseudonyms(NAMES, seed="t")
+
+
+def test_keyed_pseudonym_is_stable_when_other_names_change():
+    pseudonyms = generate_pseudonyms(NAMES, key=b"k")
+    other_pseudonyms = generate_pseudonyms(NAMES[:10] + ["OTHER1", "OTHER2"], key=b"k")
+
+    assert all(other_pseudonyms[name] == pseudonyms[name] for name in NAMES[:10])
+
+
+def test_sample_and_batch_pseudonyms_do_not_overlap():
+    # As in `output_command`: batches exclude the sample pseudonyms. Length 1 leaves 36 pseudonyms for 30 names.
+    samples = [f"S{i}" for i in range(20)]
+    batches = [f"B{i}" for i in range(10)]
+    sample_map = generate_pseudonyms(samples, length=1, seed="s", exclude=samples + batches, domain="sample_id")
+    batch_map = generate_pseudonyms(batches, length=1, seed="s", exclude=set(samples + batches) | set(sample_map.values()),
+                                    domain="batch")
+
+    assert not set(sample_map.values()) & set(batch_map.values())
+    assert len(set(sample_map.values()) | set(batch_map.values())) == 30
+
+
+def test_not_enough_pseudonyms():
+    with pytest.raises(ValueError):
+        generate_pseudonyms(NAMES[:30], length=1, exclude=[str(i) for i in range(7)])
+    with pytest.raises(ValueError):
+        generate_pseudonyms(NAMES, length=0)
@@ -0,0 +1,153 @@
+import gzip
+import os
+import zlib
+
+import pandas as pd
+import pytest
+
+import runtime_planner
+from runtime_planner import (
+    BAM,
+    COPY,
+    LINK,
+    REPLACE_STRING,
+    TEXT,
+    TEXT_GZ,
+    jobs_from_command_list,
+    jobs_from_fileinfo,
+    measure_throughputs,
+    predict_job,
+    simulate_schedule
+)
+
+
+def test_simulate_schedule_assigns_jobs_to_first_free_process():
+    jobs = [
+        {"seconds": 4.0, "output_size": 400},
+        {"seconds": 1.0, "output_size": 100},
+        {"seconds": 1.0, "output_size": 0},  # e.g. a symlink, not counted as a writer
+        {"seconds": 2.0, "output_size": 200},
+    ]
+
+    wall_time, peak_writers, peak_rate = simulate_schedule(jobs, num_process=2)
+
+    assert wall_time == 4.0
+    assert peak_writers == 2
+    assert peak_rate == 200.0
+    assert simulate_schedule(jobs, num_process=1)[:2] == (8.0, 1)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    content = ''.join(f"{i}\tSAMPLE1\n" for i in range(20000)).encode()
+    (tmp_path / "a.txt.gz").write_bytes(gzip.compress(content))
+    (tmp_path / "b.fastq.gz").write_bytes(gzip.compress(content))
+    (tmp_path / "c.bam").write_bytes(gzip.compress(content))
+    (tmp_path / "replacement.tsv").write_text("SAMPLE1\tANON\nSAMPLE2\tANON2\n")
+    return tmp_path
+
+
+def test_jobs_from_command_list(inputs):
+    commands = inputs / "command_list.sh"
+    commands.write_text(
+        f"replace_string --infilepath {inputs}/a.txt.gz --outfilepath {inputs}/out/a.txt.gz "
+        f"--replacement_file {inputs}/replacement.tsv  --num_thread 1\n"
+        f"replace_string --infilepath {inputs}/c.bam --outfilepath {inputs}/out/c.bam "
+        f"--replacement_file {inputs}/replacement.tsv  --num_thread 1\n"
+        f"mkdir -p {inputs}/out; ln -s {inputs}/b.fastq.gz {inputs}/out/b.fastq.gz\n"
+        f"cp {inputs}/b.fastq.gz {inputs}/out/b.fastq.gz\n"
+        f"gzip -cd {inputs}/a.txt.gz | sed -e s/SAMPLE1/X/g | gzip -c > {inputs}/out/a.gz ; md5sum {inputs}/out/a.gz\n"
+    )
+
+    jobs = jobs_from_command_list(str(commands))
+
+    assert [job["kind"] for job in jobs] == [REPLACE_STRING, BAM, LINK, COPY, TEXT_GZ]
+    assert jobs[0]["string_map"] == {"SAMPLE1": "ANON", "SAMPLE2": "ANON2"}
+    assert jobs[0]["compress_output"]
+    assert jobs[1]["string_map"] == jobs[0]["string_map"]
+    assert [job["md5"] for job in jobs] == [False, False, False, False, True]
+    assert jobs[4]["string_map"] == {"SAMPLE1": "X"}
+
+
+def test_predict_replace_string_job(inputs):
+    job = {"filepath": str(inputs / "a.txt.gz"), "kind": REPLACE_STRING, "md5": True, "string_map": {},
+           "replacement_file": str(inputs / "replacement.tsv"), "compress_output": True}
+    input_size = os.path.getsize(job["filepath"])
+    throughputs = {
+        runtime_planner.throughput_key(job): {"startup": 0.25, "pipeline": 10.0 * input_size},
+        "ratios": {job["filepath"]: {"ratio": 5.0, "replace_ratio": 1.0, "output_ratio": 0.5}},
+        "io": {"write": 1e12, "md5": 2.5 * input_size},
+    }
+
+    predicted = predict_job(job, throughputs)
+
+    assert predicted["output_size"] == int(2.5 * input_size)
+    assert predicted["seconds"] == pytest.approx(0.25 + 0.5 + 1.0)
+
+
+def test_cache_is_keyed_by_mount_point_and_input(inputs, monkeypatch):
+    calls = {"write": 0, "ratio": 0}
+    original_ratio = runtime_planner.measure_compression_ratio
+
+    def fake_write(outdir, sample_bytes):
+        calls["write"] += 1
+        return {"write": 1.0, "md5": 1.0}
+
+    def counting_ratio(filepath, *args):
+        calls["ratio"] += 1
+        return original_ratio(filepath, *args)
+
+    mount_points = {str(inputs / "disk1"): "/mnt/disk1", str(inputs / "disk2"): "/mnt/disk2"}
+    monkeypatch.setattr(runtime_planner, "measure_write_throughput", fake_write)
+    monkeypatch.setattr(runtime_planner, "measure_compression_ratio", counting_ratio)
+    monkeypatch.setattr(runtime_planner, "mount_point", lambda path: mount_points[path])
+    jobs = [{"filepath": str(inputs / "a.txt.gz"), "kind": TEXT_GZ, "md5": False, "string_map": {"SAMPLE1": "X"}}]
+    cache_file = str(inputs / "cache.json")
+
+    measure_throughputs(jobs, outdir=str(inputs / "disk1"), sample_mb=1, cache_file=cache_file)
+    measure_throughputs(jobs, outdir=str(inputs / "disk1"), sample_mb=1, cache_file=cache_file)
+    assert calls == {"write": 1, "ratio": 1}
+
+    measure_throughputs(jobs, outdir=str(inputs / "disk2"), sample_mb=1, cache_file=cache_file)
+    assert calls == {"write": 2, "ratio": 1}
+
+    (inputs / "a.txt.gz").write_bytes(gzip.compress(b"changed\n" * 100))
+    os.utime(inputs / "a.txt.gz", (0, 0))
+    throughputs = measure_throughputs(jobs, outdir=str(inputs / "disk2"), sample_mb=1, cache_file=cache_file)
+    assert calls == {"write": 2, "ratio": 2}
+    assert throughputs[f"ratio:{inputs / 'a.txt.gz'}"]["ratio"] == pytest.approx(800 / os.path.getsize(inputs / "a.txt.gz"))
+
+
+def test_output_size_follows_anonymised_id_length(inputs):
+    (inputs / "a.txt").write_bytes(gzip.decompress((inputs / "a.txt.gz").read_bytes()))
+    df_fileinfo = pd.DataFrame({"filepath": [str(inputs / "a.txt"), str(inputs / "a.txt.gz")],
+                                "filetype": ["vcf", "vcf"], "batch": ["B", "B"], "sample_id": ["SAMPLE1", "SAMPLE1"]})
+    jobs = jobs_from_fileinfo(df_fileinfo, anon_strlength=27)
+    throughputs = measure_throughputs(jobs, outdir=str(inputs), sample_mb=1, cache_file=None)
+    text_job, gz_job = [predict_job(job, throughputs) for job in jobs]
+
+    content = ''.join(f"{i}\t{'X' * 27}\n" for i in range(20000)).encode()
+    assert [job["kind"] for job in jobs] == [TEXT, TEXT_GZ]
+    assert text_job["output_size"] == pytest.approx(len(content), rel=1e-3)
+    assert gz_job["output_size"] == pytest.approx(len(zlib.compress(content, 6)), rel=1e-2)
+
+
+def test_ratios_are_sampled_from_the_largest_inputs(inputs, monkeypatch):
+    sampled = []
+    original_ratio = runtime_planner.measure_compression_ratio
+
+    def recording_ratio(filepath, *args):
+        sampled.append(os.path.basename(filepath))
+        return original_ratio(filepath, *args)
+
+    monkeypatch.setattr(runtime_planner, "measure_compression_ratio", recording_ratio)
+    jobs = []
+    for i in range(5):
+        (inputs / f"{i}.txt").write_text("SAMPLE1\n" * (i + 1) * 100)
+        jobs.append({"filepath": str(inputs / f"{i}.txt"), "kind": TEXT, "md5": False,
+                     "string_map": {"SAMPLE1": "XX"}})
+
+    throughputs = measure_throughputs(jobs, outdir=str(inputs), sample_mb=1, cache_file=None, ratio_sample_files=2)
+
+    assert sorted(sampled) == ["3.txt", "4.txt"]
+    assert throughputs["ratios"][str(inputs / "0.txt")]["replace_ratio"] == pytest.approx(3 / 8)
@@ -0,0 +1,128 @@
+import argparse
+import gzip
+import hashlib
+import os
+
+import pandas as pd
+import pytest
+from Bio.bgzf import BgzfWriter
+
+import main
+import verify_outputs
+from file_replace_string import compile_string_replacement_file
+from verify_outputs import (
+    MD5_MISMATCH,
+    MD5_MISSING,
+    MD5_OK,
+    UNREADABLE,
+    init_worker,
+    keys_from_fileinfo,
+    list_output_files,
+    scan_file
+)
+
+
+@pytest.fixture(autouse=True)
+def small_buffer(monkeypatch):
+    # Small enough that keys straddle chunk boundaries.
+    monkeypatch.setattr(verify_outputs, "VERIFY_BUFFER_SIZE", 7)
+    init_worker(["SAMPLE1", "SAMPLE10", "S2"])
+
+
+def test_matches_across_chunks_with_offsets(tmp_path):
+    outfile = tmp_path / "a.txt"
+    outfile.write_bytes(b"hello SAMPLE1 and SAMPLE10 xxS2")
+
+    reportpath, hits, md5_status = scan_file((str(outfile), "b/a.txt", 100))
+
+    assert reportpath == "b/a.txt"
+    assert hits == [("SAMPLE1", 6), ("SAMPLE10", 18), ("S2", 29)]
+    assert md5_status == MD5_MISSING
+
+
+def test_offsets_are_in_decompressed_bgzf_content(tmp_path):
+    outfile = tmp_path / "a.vcf.gz"
+    writer = BgzfWriter(str(outfile))
+    writer.write(b"x" * 70000 + b"S2\n")
+    writer.close()
+
+    assert scan_file((str(outfile), "a.vcf.gz", 100))[1] == [("S2", 70000)]
+
+
+def test_key_in_path_and_max_hits(tmp_path):
+    outfile = tmp_path / "out.txt"
+    outfile.write_bytes(b"S2 " * 10)
+
+    hits = scan_file((str(outfile), "SAMPLE1/out.txt", 3))[1]
+
+    assert hits == [("SAMPLE1", -1), ("S2", 0), ("S2", 3)]
+
+
+def test_md5_sidecar(tmp_path):
+    outfile = tmp_path / "clean.txt"
+    outfile.write_bytes(b"nothing\n")
+    (tmp_path / "clean.txt.md5").write_text(f"{hashlib.md5(b'nothing').hexdigest()}  clean.txt\n")
+    assert scan_file((str(outfile), "clean.txt", 100))[2] == MD5_MISMATCH
+
+    (tmp_path / "clean.txt.md5").write_text(f"{hashlib.md5(b'nothing' + bytes([10])).hexdigest()}  clean.txt\n")
+    assert scan_file((str(outfile), "clean.txt", 100))[2] == MD5_OK
+
+
+def test_sidecars_are_scanned_even_when_symlinked(tmp_path):
+    source = tmp_path / "source"
+    outdir = tmp_path / "out"
+    source.mkdir()
+    outdir.mkdir()
+    (source / "SAMPLE1_R1.fastq.gz.md5").write_text("d41d8cd98f00b204e9800998ecf8427e  SAMPLE1_R1.fastq.gz\n")
+    (source / "SAMPLE1_R1.fastq.gz").write_bytes(b"")
+    os.symlink(source / "SAMPLE1_R1.fastq.gz.md5", outdir / "ANON_R1.fastq.gz.md5")
+    os.symlink(source / "SAMPLE1_R1.fastq.gz", outdir / "ANON_R1.fastq.gz")
+
+    filelist = list_output_files(str(outdir))
+
+    assert [reportpath for filepath, reportpath in filelist] == ["ANON_R1.fastq.gz.md5"]
+    assert scan_file(filelist[0] + (100,))[1] == [("SAMPLE1", 34)]
+
+
+@pytest.mark.parametrize("content", [
+    gzip.compress(b"SAMPLE1\n" * 1000)[:50],
+    b"\x1f\x8b" + b"not a gzip stream at all",
+])
+def test_corrupt_or_truncated_file_is_unreadable(tmp_path, content):
+    outfile = tmp_path / "bad.gz"
+    outfile.write_bytes(content)
+
+    assert scan_file((str(outfile), "bad.gz", 100))[2] == UNREADABLE
+
+
+def test_keys_from_fileinfo_ignores_blank_entries():
+    df_fileinfo = pd.DataFrame({
+        "sample_id": ["S1", None, " "],
+        "replacements": ["A:B,C:D", None, None],
+    })
+
+    assert keys_from_fileinfo(df_fileinfo) == {"S1", "A", "C"}
+
+
+def test_verify_without_keys_fails_before_scanning(tmp_path):
+    replacement_file = tmp_path / "empty.tsv"
+    replacement_file.write_text("")
+    args = argparse.Namespace(fileinfo=None, replacement_file=str(replacement_file), outdir=str(tmp_path),
+                              multiprocessing=2, follow_symlinks=False, max_hits=100, outfilepath=None)
+
+    with pytest.raises(ValueError, match="No original strings"):
+        main.verify(args)
+
+
+def test_compiled_map_is_searched_like_keys(tmp_path):
+    outfile = tmp_path / "a.txt"
+    outfile.write_bytes(b"hello SAMPLE1 and SAMPLE3 xxS2")
+    init_worker(["SAMPLE1", "SAMPLE3", "S2"])
+    expected = scan_file((str(outfile), "S2/a.txt", 100))
+    replacement_file = tmp_path / "replacement.tsv"
+    replacement_file.write_text("SAMPLE1\tA\nSAMPLE3\tB\nS2\tC\n")
+    compile_string_replacement_file(str(replacement_file), str(tmp_path / "replacement.map"))
+    init_worker(compiled_path=str(tmp_path / "replacement.map"))
+
+    assert scan_file((str(outfile), "S2/a.txt", 100)) == expected
+    assert expected[1] == [("S2", -1), ("SAMPLE1", 6), ("SAMPLE3", 18), ("S2", 28)]
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import zlib
+from file_replace_string import (
+    CompiledReplacementMap,
+    build_matcher,
+    is_gzip,
+    iter_decompressed_chunks
+)
+
+VERIFY_BUFFER_SIZE = 4 * 1024 * 1024
+MD5_OK = "ok"
+MD5_MISMATCH = "mismatch"
+MD5_MISSING = "no_md5"
+UNREADABLE = "unreadable"
+
+# Set in each worker process by `init_worker`: a function returning the (start, end) offsets of the keys
+# found in some bytes, and the length in bytes of the longest key.
+_FIND_KEYS = None
+_MAX_KEY_LENGTH = 0
+
+
+########################################################################################################
+# Worker
+########################################################################################################
+
+
+def init_worker(keys=None, compiled_path=None):
+    """
+    Set up the key search in the current process, either by compiling a matcher for `keys`,
+    or by memory-mapping the replacement map compiled at `compiled_path`, whose keys are searched
+    directly in the shared map without any per-process compilation.
+    """
+    global _FIND_KEYS, _MAX_KEY_LENGTH
+    if compiled_path is not None:
+        replacement_map = CompiledReplacementMap(compiled_path)
+        _FIND_KEYS = replacement_map.find
+        _MAX_KEY_LENGTH = replacement_map.max_key_length
+    else:
+        matcher = build_matcher(keys)
+
+        def find_keys(data):
+            return [m.span() for m in matcher.finditer(data)]
+        _FIND_KEYS = find_keys
+        _MAX_KEY_LENGTH = max(len(key.encode("utf-8")) for key in keys)
+
+
+class _HashingReader:
+    """
+    Wrap a binary file handle so that every byte read is also fed to `hasher`.
+    """
+
+    def __init__(self, filehandle, hasher):
+        self.filehandle = filehandle
+        self.hasher = hasher
+
+    def read(self, size):
+        data = self.filehandle.read(size)
+        self.hasher.update(data)
+        return data
+
+
+def scan_file(param):
+    """
+    Scan the (decompressed) content and the path of a file for any of the keys given
+    to `init_worker`, and check the file against its `.md5` sidecar if there is one.
+    Gzip, BGZF and BAM files are decompressed before scanning. The file is read only once.
+
+    :param param: (str, str, int)
+    Path to the file, the path to report it as and the maximum number of hits to report.
+
+    :return: (str, list of (str, int), str)
+    The reported path, (key, offset) of residual keys and the md5 status. An offset of -1
+    means the key was found in the path. Other offsets are in the decompressed content.
+    The status is `UNREADABLE` if the file is corrupt or truncated, in which case
+    hits are only reported up to the point of failure.
+    """
+    filepath, reportpath, max_hits = param
+    path = reportpath.encode("utf-8")
+    hits = [(path[start:end].decode("utf-8"), -1) for start, end in _FIND_KEYS(path)]
+    hasher = hashlib.md5()
+    overlap = _MAX_KEY_LENGTH - 1
+    tail = b''
+    consumed = 0
+    try:
+        with open(filepath, 'rb') as infile:
+            reader = _HashingReader(infile, hasher)
+            for chunk in iter_decompressed_chunks(reader, VERIFY_BUFFER_SIZE, is_gzip(filepath)):
+                # Keep the end of the previous chunk so that keys spanning two chunks are found,
+                # and skip matches lying entirely within it as they have been reported already.
+                window = tail + chunk
+                for start, end in _FIND_KEYS(window):
+                    if end > len(tail) and len(hits) < max_hits:
+                        hits.append((window[start:end].decode("utf-8"), consumed - len(tail) + start))
+                consumed += len(chunk)
+                tail = window[-overlap:] if overlap else b''
+    except (zlib.error, EOFError, OSError):
+        return reportpath, hits, UNREADABLE
+
+    md5path = f"{filepath}.md5"
+    if not os.path.isfile(md5path):
+        md5_status = MD5_MISSING
+    else:
+        with open(md5path) as md5file:
+            fields = md5file.read().split()
+        md5_status = MD5_OK if fields and fields[0] == hasher.hexdigest() else MD5_MISMATCH
+    return reportpath, hits, md5_status
+
+
+########################################################################################################
+# Utilities
+########################################################################################################
+
+
+def list_output_files(outdir, follow_symlinks=False):
+    """
+    List every file under `outdir` to be verified, as (path, path relative to `outdir`).
+    Symlinks point at unmodified input and are skipped unless `follow_symlinks` is True.
+    `.md5` sidecars are always included, even when symlinked, since the md5sum output
+    they hold names the original file.
+    """
+    filelist = []
+    for root, directories, files in os.walk(outdir):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            if os.path.islink(filepath) and not follow_symlinks and not filename.endswith(".md5"):
+                continue
+            filelist.append((filepath, os.path.relpath(filepath, start=outdir)))
+    return filelist
+
+
+def keys_from_fileinfo(df_fileinfo):
+    """
+    Collect the original strings `output_command` replaces: every sample_id and
+    every key of the optional `replacements` column. Blank entries are ignored.
+    """
+    keys = set(df_fileinfo["sample_id"].dropna())
+    if "replacements" in df_fileinfo.columns:
+        for replacements in df_fileinfo["replacements"].dropna():
+            for pair in replacements.split(','):
+                key, val = pair.split(':')
+                keys.add(key)
+    return {key for key in keys if key.strip()}